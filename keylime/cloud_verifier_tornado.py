@@ -1980,6 +1980,10 @@ def main() -> None:
 
     config.check_version("verifier", logger=logger)
 
+    # Bring the durable attestation persistent store up to date, before any of the worker processes writes to it
+    if rmc:
+        rmc.upgrade_store()
+
     verifier_port = config.get("verifier", "port")
     verifier_host = config.get("verifier", "ip")
     verifier_id = config.get("verifier", "uuid", fallback=cloud_verifier_common.DEFAULT_VERIFIER_ID)
@@ -2059,6 +2063,9 @@ def main() -> None:
         asyncio.ensure_future(activate_agents(agents, verifier_host, int(verifier_port)))
         tornado.ioloop.IOLoop.current().start()
         logger.debug("Server %s stopped.", task_id)
+        # Worker processes do not run atexit handlers, so write any durable attestation records still buffered now
+        if rmc:
+            rmc.flush()
         sys.exit(0)
 
     processes: List[Process] = []
@@ -1,4 +1,6 @@
+import signal
 import sys
+from typing import Any
 
 import cryptography
 
@@ -31,6 +33,11 @@ def _check_devid_requirements() -> None:
             )
 
 
+def _shutdown(*_: Any) -> None:
+    """Exits the current process through SystemExit, so that cleanup code runs as the call stack unwinds"""
+    sys.exit(0)
+
+
 def main() -> None:
     logger.info("Starting Keylime registrar...")
 
@@ -46,10 +53,20 @@ def main() -> None:
     db_manager.make_engine("registrar")
     # Prepare backend for durable attestation, if configured
     da_manager.make_backend("registrar")
+    da_manager.upgrade_store()
 
     # Start HTTP server
     server = RegistrarServer()
-    server.start_multi()
+
+    # Tornado worker processes would otherwise be terminated by SIGTERM without unwinding, losing any durable
+    # attestation records still queued. The handler is inherited by each worker when it is forked
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    try:
+        server.start_multi()
+    finally:
+        # Write any durable attestation records still queued before the process exits
+        da_manager.flush()
 
 
 if __name__ == "__main__":
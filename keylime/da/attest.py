@@ -94,6 +94,10 @@ def main() -> None:
         logger.info("===> Getting all existing attestation records for agent %s ...", agent_uuid)
         attestation_record_list = rmc.record_read(agent_uuid, start_date, end_date, "verifier")
 
+        if not attestation_record_list:
+            logger.info("=====> No attestation records to verify for agent %s", agent_uuid)
+            continue
+
         logger.info("=====> Verifing the state of agent %s over time...", agent_uuid)
 
         p_tpm_ts = 0
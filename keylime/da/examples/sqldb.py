@@ -1,9 +1,22 @@
+import atexit
+import itertools
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy
-import sqlalchemy.ext.declarative
+import sqlalchemy.orm
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
 
-from keylime import keylime_logging
+try:
+    from sqlalchemy.orm import declarative_base  # sqlalchemy >= 1.4.
+except ImportError:
+    from sqlalchemy.ext.declarative import declarative_base
+
+from keylime import config, keylime_logging
 from keylime.da.record import BaseRecordManagement, base_build_key_list
 
 logger = keylime_logging.init_logging("durable_attestation_persistent_store")
@@ -12,27 +25,48 @@ logger = keylime_logging.init_logging("durable_attestation_persistent_store")
 # sqlalchemy table descriptions
 # ######################################################
 
-TableBase = sqlalchemy.ext.declarative.declarative_base()
+TableBase = declarative_base()
 
 
 class AttestationRecord(TableBase):
     __tablename__ = "AttestationRecord"
-    time = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    time = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
     agentid = sqlalchemy.Column(sqlalchemy.String(128), primary_key=True)
     record = sqlalchemy.Column(sqlalchemy.LargeBinary(length=(2**32) - 1))
+    # Allows the latest record(s) of an agent to be found with an index seek, as the (time, agentid) primary key
+    # cannot be used for lookups by agentid
+    __table_args__ = (sqlalchemy.Index("ix_AttestationRecord_agentid_time", agentid, time.desc()),)
 
 
 class RegistrationRecord(TableBase):
     __tablename__ = "RegistrationRecord"
-    time = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    time = sqlalchemy.Column(sqlalchemy.BigInteger, primary_key=True)
     agentid = sqlalchemy.Column(sqlalchemy.String(128), primary_key=True)
     record = sqlalchemy.Column(sqlalchemy.LargeBinary(length=(2**32) - 1))
+    # Allows the latest record(s) of an agent to be found with an index seek, as the (time, agentid) primary key
+    # cannot be used for lookups by agentid
+    __table_args__ = (sqlalchemy.Index("ix_RegistrationRecord_agentid_time", agentid, time.desc()),)
+
+
+class StoreVersion(TableBase):
+    __tablename__ = "StoreVersion"
+    version = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+
+# Version of the layout of the records in the persistent store. Version 1 timestamps records in seconds and version 2
+# in milliseconds
+STORE_VERSION = 2
+
+RECORD_TYPE_TABLES = {"registration": RegistrationRecord, "attestation": AttestationRecord}
 
 
 def type2table(recordtype):
-    if "registration" in recordtype:
-        return RegistrationRecord
-    return AttestationRecord
+    return RECORD_TYPE_TABLES.get(recordtype, AttestationRecord)
+
+
+def key_only(record_object):
+    """Reduces a registration record to the AIK needed by base_build_key_list"""
+    return {"agent": {"aik_tpm": record_object["agent"]["aik_tpm"]}}
 
 
 # ######################################################
@@ -44,18 +78,202 @@ class RecordManagement(BaseRecordManagement):
     def __init__(self, service):
         BaseRecordManagement.__init__(self, service)
 
-        self.engine = sqlalchemy.create_engine(self.ps_url._replace(fragment="").geturl(), pool_recycle=1800)
-        sm = sqlalchemy.orm.sessionmaker()
+        # Use the configured URL as is, as urlparse() would drop the empty host of a SQLite URL (sqlite:///path)
+        url = config.get(self.svc, "persistent_store_url", fallback="").split("#")[0]
+        engine_args = {"pool_recycle": 1800}
+
+        if not url.count("sqlite:"):
+            p_sz, m_ovfl = config.get(self.svc, "persistent_store_pool_sz_ovfl", fallback="16,32").split(",")
+            engine_args["pool_size"] = int(p_sz)
+            engine_args["max_overflow"] = int(m_ovfl)
+            engine_args["pool_pre_ping"] = True
+
+        self.engine = sqlalchemy.create_engine(url, **engine_args)
+        sm = sqlalchemy.orm.sessionmaker(expire_on_commit=False)
         self.session = sqlalchemy.orm.scoped_session(sm)
         self.session.configure(bind=self.engine)
+
+        # A persistent store without any record table is new, and so starts at the current version. Any other is
+        # left at the version it is (or at version 1, if it predates StoreVersion) until upgrade_store() is called
+        existing_tables = sqlalchemy.inspect(self.engine).get_table_names()
+        new_store = not any(tbl.__tablename__ in existing_tables for tbl in RECORD_TYPE_TABLES.values())
         TableBase.metadata.create_all(self.engine)
 
+        if new_store:
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(StoreVersion.__table__.insert().values(version=STORE_VERSION))
+            except sqlalchemy.exc.IntegrityError:
+                # Another service created the persistent store at the same time
+                pass
+
+        self.store_version = self._store_version()
+        # Number of records whose timestamps are rescaled per transaction when upgrading the persistent store
+        self.upgrade_batch_size = 500
+
+        # Records are queued per table and written with a single multi-row INSERT once "batch_size" records have
+        # accumulated, or after "flush_interval" seconds, whichever comes first. Batching is opt-in, as queued records
+        # are lost if the process is killed before they are written: by default, each record is written right away
+        self.batch_size = config.getint(self.svc, "persistent_store_batch_size", fallback=1)
+        self.flush_interval = config.getfloat(self.svc, "persistent_store_flush_interval", fallback=5.0)
+        self.queues = {AttestationRecord: deque(), RegistrationRecord: deque()}
+        # Build the INSERT statements once, so that every flush reuses the same (cached) compiled statement
+        self.insert_stmts = {tbl: tbl.__table__.insert() for tbl in self.queues}
+        self.queue_lock = threading.Lock()
+        # Held from the moment queued records are taken off a queue until they are written, so that a flush on
+        # shutdown waits for any write already in progress (e.g., by the flush timer) to complete
+        self.flush_lock = threading.Lock()
+        self.flush_timer = None
+        atexit.register(self.flush)
+
+        # Number of rows fetched at a time when reading records back from the persistent store
+        self.page_size = 200
+
+        # When a Transparency Log or a Time Stamp Authority is used, the checks of each chunk of rows run in parallel:
+        # they mostly wait on OpenSSL, "rekor-cli" and the TSA, all of which release the GIL
+        self.max_workers = os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # The verifier and the registrar fork their worker processes after the backend is created (and used, e.g., to
+        # upgrade the persistent store), so make sure each worker starts afresh rather than sharing its parent's state
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Drop, without closing them, the pooled connections and the session inherited from the parent process, which
+        # the parent may still use
+        self.session.registry.clear()
+        try:
+            self.engine.dispose(close=False)
+        except TypeError:
+            # sqlalchemy < 1.4.33
+            self.engine.dispose()
+
+        # Records queued by the parent are the parent's to write, and neither its threads (flush timer and executor
+        # workers) nor the state of its locks carry over to the child
+        self.queues = {tbl: deque() for tbl in self.queues}
+        self.queue_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_timer = None
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _store_version(self):
+        """Returns the version of the layout of the records in the persistent store, as recorded in StoreVersion, or
+        the version of the layout predating StoreVersion if nothing is recorded there"""
+        with self.engine.connect() as conn:
+            return max((row.version for row in conn.execute(StoreVersion.__table__.select())), default=1)
+
+    def upgrade_store(self):
+        """Brings a persistent store created by an older version of this module up to date. Meant to be called once
+        by the services writing records, when they start, before any record is written: the upgrade is recorded in
+        StoreVersion, so it only runs once for any given persistent store"""
+        if self.store_version >= STORE_VERSION:
+            return
+
+        self.store_version = self._store_version()
+        if self.store_version >= STORE_VERSION:
+            return
+
+        logger.info("Upgrading the durable attestation persistent store to version %d", STORE_VERSION)
+
+        # The schema changes below are DDL, which some engines (e.g., MySQL) commit implicitly, and the timestamps are
+        # rescaled in many short transactions, so the upgrade is not atomic. It does not need to be: every step is
+        # skipped, or has no effect, when it was already carried out. In particular, only timestamps no later than
+        # "end_of_times" (i.e., still in seconds) are rescaled, so an upgrade which was interrupted, or which runs in
+        # two services at the same time, never rescales a timestamp twice. The marker is only recorded once all the
+        # timestamps have been rescaled
+        for tbl in (AttestationRecord, RegistrationRecord):
+            with self.engine.begin() as conn:
+                self._upgrade_table(conn, tbl)
+
+            self._rescale_times(tbl)
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(StoreVersion.__table__.insert().values(version=STORE_VERSION))
+        except sqlalchemy.exc.IntegrityError:
+            # Another service completed the upgrade at the same time
+            pass
+
+        self.store_version = STORE_VERSION
+        logger.info("Upgraded the durable attestation persistent store to version %d", STORE_VERSION)
+
+    def _upgrade_table(self, conn, tbl):
+        inspector = sqlalchemy.inspect(conn)
+        time_column = next(c for c in inspector.get_columns(tbl.__tablename__) if c["name"] == "time")
+
+        # "time" used to be an INTEGER (too narrow for milliseconds on most engines, but not on SQLite, which does not
+        # support altering columns anyway)
+        if not isinstance(time_column["type"], sqlalchemy.BigInteger) and self.engine.dialect.name != "sqlite":
+            Operations(MigrationContext.configure(conn)).alter_column(
+                tbl.__tablename__,
+                "time",
+                existing_type=sqlalchemy.Integer,
+                type_=sqlalchemy.BigInteger,
+                existing_nullable=False,
+            )
+
+        # Also allows the records still to be rescaled to be found in (agentid, time) order with an index scan
+        existing_indexes = {index["name"] for index in inspector.get_indexes(tbl.__tablename__)}
+        for index in tbl.__table__.indexes:
+            if index.name not in existing_indexes:
+                index.create(conn)
+
+    def _rescale_times(self, tbl):
+        """Rescales the timestamps of the records, which used to be in seconds, to milliseconds. As "time" is part of
+        the primary key, every record updated is moved (and logged) by the database, so records are updated in short
+        transactions of at most "upgrade_batch_size" records rather than all at once"""
+        end_of_times = self.end_of_times
+
+        remaining = (
+            self.session.query(sqlalchemy.func.count(tbl.time))  # pylint: disable=no-member
+            .filter(tbl.time <= end_of_times)
+            .scalar()
+        )
+        self.session.commit()  # pylint: disable=no-member
+
+        done = 0
+        while True:
+            # Records already rescaled are later than "end_of_times" (as is any time in milliseconds since 1973), so
+            # each batch picks up where the previous one left off, in (agentid, time) order
+            keys = (
+                self.session.query(tbl.agentid, tbl.time)  # pylint: disable=no-member
+                .filter(tbl.time <= end_of_times)
+                .order_by(tbl.agentid, tbl.time)
+                .limit(self.upgrade_batch_size)
+                .all()
+            )
+
+            if not keys:
+                break
+
+            # The batch holds, for each of its agents, all the records still in seconds between the first and the last
+            # timestamp seen for that agent
+            ranges = {}
+            for agentid, t in keys:
+                first_time, _ = ranges.get(agentid, (t, t))
+                ranges[agentid] = (first_time, t)
+
+            for agentid, (first_time, last_time) in ranges.items():
+                self.session.execute(  # pylint: disable=no-member
+                    tbl.__table__.update()
+                    .where(tbl.agentid == agentid)
+                    .where(tbl.time >= first_time)
+                    .where(tbl.time <= last_time)
+                    .values(time=tbl.time * 1000)
+                )
+            self.session.commit()  # pylint: disable=no-member
+
+            done += len(keys)
+            logger.info("Rescaled the timestamps of %d of %d records in %s", done, remaining, tbl.__tablename__)
+
     def agent_list_retrieval(self, record_prefix="auto", service="auto"):
         if record_prefix == "auto":
             record_prefix = ""
 
         agent_list = []
 
+        self.flush()
+
         recordtype = self.get_record_type(service)
         tbl = type2table(recordtype)
         for agentid in self.session.query(tbl.agentid).distinct():  # pylint: disable=no-member
@@ -73,7 +291,8 @@ class RecordManagement(BaseRecordManagement):
         signed_attributes="auto",
     ):
         agentid = agent_data["agent_id"]
-        recordtime = str(int(time.time()))
+        # Milliseconds make records of the same agent created within the same second less likely to collide
+        recordtime = time.time_ns() // 1_000_000
         recordtype = self.get_record_type(service)
 
         # create the record, and sign it.
@@ -82,12 +301,73 @@ class RecordManagement(BaseRecordManagement):
         rcrd = self.base_record_create(record_object, agent_data, attestation_data, mb_policy_data, runtime_policy_data)
 
         d = {"time": recordtime, "agentid": agentid, "record": rcrd}
+        tbl = type2table(recordtype)
+
+        with self.queue_lock:
+            self.queues[tbl].append(d)
+
+            if len(self.queues[tbl]) < self.batch_size:
+                self._schedule_flush()
+                return
+
+        self._write_queued([tbl])
+
+    def _schedule_flush(self):
+        # Must be called with self.queue_lock held
+        if self.flush_timer or self.flush_interval <= 0:
+            return
+
+        self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _drain(self, tbl):
+        # Must be called with self.queue_lock held
+        batch = list(self.queues[tbl])
+        self.queues[tbl].clear()
+        return batch
+
+    def _flush(self, tbl, batch):
+        if not batch:
+            return
 
         try:
-            self.session.add((type2table(recordtype))(**d))  # pylint: disable=no-member
+            self.session.execute(self.insert_stmts[tbl], batch)  # pylint: disable=no-member
             self.session.commit()  # pylint: disable=no-member
+            return
         except Exception as e:
-            logger.error("Failed to create attestation record: %s", e)
+            self.session.rollback()  # pylint: disable=no-member
+            logger.warning("Failed to create a batch of %d attestation records, retrying one by one: %s", len(batch), e)
+
+        # A single bad record (e.g., a duplicate primary key) should not cause the whole batch to be lost
+        for d in batch:
+            try:
+                self.session.execute(self.insert_stmts[tbl], d)  # pylint: disable=no-member
+                self.session.commit()  # pylint: disable=no-member
+            except Exception as e:
+                self.session.rollback()  # pylint: disable=no-member
+                logger.error("Failed to create attestation record: %s", e)
+
+    def _write_queued(self, tbls):
+        with self.flush_lock:
+            with self.queue_lock:
+                batches = [(tbl, self._drain(tbl)) for tbl in tbls]
+
+            for tbl, batch in batches:
+                self._flush(tbl, batch)
+
+    def flush(self):
+        """Writes all queued records to the persistent store"""
+        with self.queue_lock:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+
+        self._write_queued(self.queues)
+
+        # The flush timer runs in a new thread each time, so do not leave its thread-local session behind
+        if isinstance(threading.current_thread(), threading.Timer):
+            self.session.remove()  # pylint: disable=no-member
 
     def record_signature_create(
         self, record_object, agent_data, attestation_data, service="auto", signed_attributes="auto"
@@ -98,40 +378,113 @@ class RecordManagement(BaseRecordManagement):
 
         self.base_record_timestamp_create(record_object, agent_data, contents)
 
-    def _bulk_record_retrieval(self, record_identifier, start_date=0, end_date="auto", service="auto"):
+    def _record_stream(self, record_identifier, start_date=0, end_date="auto", service="auto", sink=None):
+        # If a sink is given, each decoded record is passed through it as soon as it has been checked, and what it
+        # returns is yielded instead of the record, allowing the (possibly large) decoded record to be discarded early.
+        # Rows are then streamed from each page no more than one per worker at a time, so that at most that many raw
+        # and decoded records are held in memory at once, rather than a whole page of them
         recordtype = self.get_record_type(service)
         tbl = type2table(recordtype)
-        record_list = []
 
-        if f"{end_date}" == "auto":
-            end_date = self.end_of_times
+        self.flush()
 
-        if self.only_last_record_wanted(start_date, end_date):
-            attestion_record_rows = (
-                self.session.query(tbl)  # pylint: disable=no-member
+        end_of_times = self.end_of_times
+        if end_date == "auto":
+            end_date = end_of_times
+
+        # Same as only_last_record_wanted(), inlined as this runs on every read
+        if end_date == end_of_times and start_date == end_of_times - 1:
+            chunks = [
+                self.session.query(tbl.time, tbl.record)  # pylint: disable=no-member
                 .filter(tbl.agentid == record_identifier)
                 .order_by(sqlalchemy.desc(tbl.time))
                 .limit(1)
-            )
+                .all()
+            ]
 
         else:
-            attestion_record_rows = self.session.query(tbl).filter(  # pylint: disable=no-member
-                tbl.agentid == record_identifier
+            # Dates are given in seconds, whereas records are timestamped in milliseconds (unless the persistent store
+            # has not been upgraded yet, e.g., when it is read by a tool while no service has written to it)
+            if self.store_version < STORE_VERSION:
+                self.store_version = self._store_version()
+
+            if self.store_version < STORE_VERSION:
+                first_time, last_time = int(start_date), int(end_date)
+            else:
+                first_time, last_time = int(start_date) * 1000, int(end_date) * 1000 + 999
+
+            chunks = self._record_chunks(
+                tbl,
+                record_identifier,
+                first_time,
+                last_time,
+                self.max_workers if sink else self.page_size,
             )
 
-        for row in attestion_record_rows:
-            decoded_record_object = self.record_deserialize(row.record)
-            self.record_signature_check(decoded_record_object, record_identifier)
-            record_list.append(decoded_record_object)
-        return record_list
+        # Bind the per-row methods once, rather than looking them up on every iteration
+        record_deserialize = self.record_deserialize
+        record_signature_check = self.record_signature_check
+
+        def verify_one(record):
+            decoded_record_object = record_deserialize(record)
+            record_signature_check(decoded_record_object, record_identifier)
+            if sink:
+                return sink(decoded_record_object)
+            return decoded_record_object
+
+        # Without a Transparency Log or a Time Stamp Authority, checking a record is pure Python work (decoding it),
+        # which holds the GIL, so worker threads would only add overhead
+        mapper = self.executor.map if self.tl_url.scheme or self.tsa_url.scheme else map
+
+        for chunk in chunks:
+            # map() returns results in the same order as the rows were fetched
+            yield from mapper(verify_one, [row.record for row in chunk])
+
+    def _record_chunks(self, tbl, record_identifier, first_time, last_time, chunk_size):
+        # Each record can be up to 4 GiB, so rather than buffering the whole time range in memory, fetch it one page
+        # at a time using keyset pagination: as (time, agentid) is unique, each page picks up right after the last
+        # time seen in the previous one, which is an index range scan on (agentid, time). Each page is in turn
+        # streamed from the database, and yielded, in chunks of at most "chunk_size" rows
+        while True:
+            rows = iter(
+                self.session.query(tbl.time, tbl.record)  # pylint: disable=no-member
+                .filter(tbl.agentid == record_identifier, tbl.time >= first_time, tbl.time <= last_time)
+                .order_by(tbl.time)
+                .limit(self.page_size)
+                .yield_per(chunk_size)
+            )
+
+            fetched = 0
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                fetched += len(chunk)
+                first_time = chunk[-1].time + 1
+                yield chunk
+
+            if fetched < self.page_size:
+                return
+
+    def _bulk_record_retrieval(self, record_identifier, start_date=0, end_date="auto", service="auto"):
+        return list(self._record_stream(record_identifier, start_date, end_date, service))
 
     def build_key_list(self, agent_identifier, service="auto"):
-        record_list = self._bulk_record_retrieval(agent_identifier, service)
-        return base_build_key_list(record_list)
+        return base_build_key_list(self._record_stream(agent_identifier, service=service, sink=key_only))
 
     def record_read(self, agent_identifier, start_date, end_date, service="auto"):
         attestation_record_list = self._bulk_record_retrieval(agent_identifier, start_date, end_date, service)
 
+        # A date range with no records in it is not an error, so do not let base_record_read() reject it
+        if not attestation_record_list:
+            logger.warning(
+                "No %s records found for agent %s in the selected date range",
+                self.get_record_type(service),
+                agent_identifier,
+            )
+            return attestation_record_list
+
         self.base_record_read(attestation_record_list)
 
         return attestation_record_list
@@ -6,7 +6,7 @@ import os
 import pickle
 import tempfile
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Union
 from urllib.parse import urlparse
 
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
@@ -14,8 +14,44 @@ from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 from keylime import config, crypto, json, keylime_logging, web_util
 from keylime.fs_util import ch_dir
 
+try:
+    import msgpack
+except ModuleNotFoundError:
+    msgpack = None
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
 logger = keylime_logging.init_logging("durable_attestation")
 
+# Version byte prepended to records serialized with msgpack. JSON records always start with "{", so this allows a
+# persistent store to be switched to the "msgpack" format while still holding records written as JSON
+MSGPACK_RECORD_V1 = b"\x01"
+
+# Every Zstandard frame starts with this magic number, which allows compressed records to be told apart from
+# uncompressed ones regardless of the compression currently configured
+ZSTD_FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _json_keys_to_str(data: Any) -> Any:
+    """Converts the dict keys found in data to str the same way json.dumps() does (e.g., 10 becomes "10" and None
+    becomes "null")"""
+    if isinstance(data, dict):
+        return {_json_key_to_str(_k): _json_keys_to_str(_v) for _k, _v in data.items()}
+    if isinstance(data, list):
+        return [_json_keys_to_str(_v) for _v in data]
+    return data
+
+
+def _json_key_to_str(key: Any) -> str:
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+
 
 class BaseRecordManagement(metaclass=abc.ABCMeta):
     def __init__(self, service: str, key_tls_pub: Optional[str] = "") -> None:
@@ -32,6 +68,7 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
         self.rmv_a = ["ssl_context", "pending_event"]
         self.rcd_fmt = config.get(self.svc, "persistent_store_format", fallback="json")
         self.rcd_enc = config.get(self.svc, "persistent_store_encoding", fallback="")
+        self.rcd_cmp = config.get(self.svc, "persistent_store_compression", fallback="")
         self.rcd_sa = config.get(self.svc, "transparency_log_sign_algo", fallback="sha256")
         self.tmp_d_cl = True
         self.key_tls_priv: Optional[str] = ""
@@ -54,6 +91,14 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
     ) -> None:
         """Takes agent data, attestation data, mb policy data, ima policy data, serialize, optionally encodes it and writes to a persistent data store"""
 
+    def upgrade_store(self) -> None:
+        """Brings a persistent store written by an older version of the backend up to date. Called once by the services
+        writing records, when they start. Backends whose stored records never change layout have nothing to do here"""
+
+    def flush(self) -> None:
+        """Writes any records still buffered by the backend to the persistent store. Backends which write each record
+        as soon as it is created have nothing to do here"""
+
     def get_record_type(self, service: str) -> str:
         """Determine which "service", (initial) registration or attestation is used)"""
         if service != "auto":
@@ -90,9 +135,29 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
         elif self.rcd_fmt == "json":
             serialized_record_object = json.dumps(manipulated_record_object, indent=4).encode("utf-8")
 
+        elif self.rcd_fmt == "msgpack":
+            if not msgpack:
+                raise RecordManagementException('The "msgpack" record format requires the msgpack module')
+
+            # Convert bytes to str and dict keys to str first, as json.dumps() does, so that a record reads back with
+            # the same shape whichever format it was written in (e.g., an AIK is always a str when comparing AIKs
+            # across records). As with json.dumps(), any other type not supported is rejected with a TypeError
+            serialized_record_object = MSGPACK_RECORD_V1 + msgpack.packb(
+                _json_keys_to_str(json.bytes_to_str(manipulated_record_object)), use_bin_type=True
+            )
+
         else:
             raise Exception("Unknown or unsupported record format")
 
+        if self.rcd_cmp == "zstd":
+            if not zstandard:
+                raise RecordManagementException('The "zstd" record compression requires the zstandard module')
+
+            serialized_record_object = zstandard.ZstdCompressor(level=3).compress(serialized_record_object)
+
+        elif self.rcd_cmp:
+            raise Exception("Unknown or unsupported record compression")
+
         if self.rcd_enc == "base64":
             serialized_record_object = base64.b64encode(serialized_record_object)
 
@@ -106,10 +171,22 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
         if self.rcd_enc == "base64":
             manipulated_record_object = base64.b64decode(manipulated_record_object)
 
+        if manipulated_record_object[:4] == ZSTD_FRAME_MAGIC:
+            if not zstandard:
+                raise RecordManagementException('The "zstd" record compression requires the zstandard module')
+
+            manipulated_record_object = zstandard.ZstdDecompressor().decompress(manipulated_record_object)
+
         if self.rcd_fmt == "pickle":
             deserialized_record_object = pickle.loads(manipulated_record_object)
 
-        elif self.rcd_fmt == "json":
+        elif self.rcd_fmt == "msgpack" and manipulated_record_object[:1] == MSGPACK_RECORD_V1:
+            if not msgpack:
+                raise RecordManagementException('The "msgpack" record format requires the msgpack module')
+
+            deserialized_record_object = msgpack.unpackb(manipulated_record_object[1:], raw=False, strict_map_key=False)
+
+        elif self.rcd_fmt in ("json", "msgpack"):
             deserialized_record_object = manipulated_record_object.decode("utf-8")
             deserialized_record_object = json.loads(deserialized_record_object)
 
@@ -370,7 +447,10 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
                     pass
                 fp.write(base64.decodebytes(record_object["signature"]))
 
-            with open(self.key_tls_pub, "w", encoding="utf-8") as fp:
+            # Keep the signer's public key next to the other files of this check instead of overwriting a shared
+            # path, so that records can be checked concurrently
+            signer_pub_key_file_path = f'{record_object["temp_dir"]}/signer_pub_key.pem'
+            with open(signer_pub_key_file_path, "w", encoding="utf-8") as fp:
                 fp.write(record_object["signer_pub_key"])
 
             _contents_to_check = {}
@@ -384,7 +464,7 @@ class BaseRecordManagement(metaclass=abc.ABCMeta):
             if "contents_file_path" in record_object and "signature_file_path" in record_object:
                 if self.tl_url.scheme == "http" and self.tl_url.netloc.count("3000"):
                     getattr(importlib.import_module(self.st_imp_path + ".rekor"), "record_signature_check")(
-                        record_object, agent_data, self.tl_url, self.key_tls_pub
+                        record_object, agent_data, self.tl_url, signer_pub_key_file_path
                     )
 
         return _contents_to_check
@@ -399,7 +479,7 @@ class RecordManagementException(Exception):
     pass
 
 
-def base_build_key_list(registration_record_list: List[Dict[Any, Any]]) -> List[str]:
+def base_build_key_list(registration_record_list: Iterable[Dict[Any, Any]]) -> List[str]:
     """Just assembles a simple list of AIKs used by an agent"""
 
     aik_list: List[str] = []
@@ -28,6 +28,16 @@ class DAManager:
             logger.error("Error initializing Durable Attestation: %s", rme)
             sys.exit(1)
 
+    def upgrade_store(self) -> None:
+        """Brings the persistent store of the durable attestation backend up to date, if one is configured"""
+        if self._backend:
+            self._backend.upgrade_store()
+
+    def flush(self) -> None:
+        """Writes any records still buffered by the durable attestation backend, if one is configured"""
+        if self._backend:
+            self._backend.flush()
+
     @property
     def service(self) -> Optional[str]:
         return self._service
@@ -6,7 +6,12 @@ Instead, this plugin targets models specifically and modifies the in-memory Astr
 to eliminate the conditions which produce the errors/warnings prior to consumption by Pylint.
 """
 
+import copy
+import functools
+import hashlib
+import json
 import os
+import tempfile
 from typing import TYPE_CHECKING
 
 import astroid
@@ -18,6 +23,10 @@ if TYPE_CHECKING:
 # (e.g., ``self._field("name")`` creates a new property to allow the field to be accessed with ``model.name``)
 MODEL_TRANSFORMING_METHODS = ["_field", "_id", "_has_one", "_has_many", "_belongs_to"]
 
+# Version of the on-disk cache of exports, to be incremented whenever the way the exports are obtained changes so that
+# caches written by earlier versions of the plugin are not reused
+CACHE_VERSION = 1
+
 # List of all DSL constructs exported by keylime.model.base, to be populated on plugin registration
 base_exports: list[str] = []
 
@@ -26,17 +35,33 @@ def register(_linter: "PyLinter") -> None:
     """Obtains the exports of the ``keylime.model.base`` package by parsing ``keylime/model/base/__init__.py`` into
     an abstract syntax tree (AST) and iterating through the ``import`` statements contained within. Called by Pylint
     on plugin registration.
+
+    As the exports only change when ``__init__.py`` does, they are cached on disk keyed by a hash of the file contents
+    (and the version of the cache), so that later Pylint runs can skip parsing the file.
     """
     if base_exports:
         return
 
+    fake_import_use_template()
+
     path = os.path.dirname(os.path.realpath(__file__))
     path = os.path.join(path, "__init__.py")
 
-    with open(path, encoding="utf-8") as f:
+    with open(path, "rb") as f:
         init_contents = f.read()
 
-    init_mod = astroid.parse(init_contents)
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "keylime-pylint")
+    cache_key = hashlib.blake2b(init_contents, digest_size=16).hexdigest()
+    cache_path = os.path.join(cache_dir, f"exports-v{CACHE_VERSION}-{cache_key}.json")
+
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            base_exports.extend(json.load(f))
+        return
+    except (OSError, ValueError):
+        pass
+
+    init_mod = astroid.parse(init_contents.decode("utf-8"))
 
     if not init_mod.body:
         return
@@ -46,6 +71,59 @@ def register(_linter: "PyLinter") -> None:
             for name in item.names:
                 base_exports.append(name[1] or name[0])
 
+    # Failing to write the cache (e.g., because the home directory is read-only) should not fail the Pylint run. The
+    # cache is written to a temporary file which is then renamed, so that parallel Pylint processes (``pylint -j``)
+    # never read a partially written cache
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir, suffix=".tmp", delete=False) as f:
+            json.dump(base_exports, f)
+        try:
+            os.replace(f.name, cache_path)
+        except OSError:
+            os.unlink(f.name)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def base_import_names() -> "list[tuple[str, str | None]]":
+    """Produces, from the list of base imports obtained by the ``register(...)`` function, a list of import names
+    without any aliases (specifying None). Computed once per Pylint run.
+    """
+    return [(name, None) for name in base_exports]
+
+
+@functools.lru_cache(maxsize=None)
+def fake_import_use_template() -> astroid.FunctionDef:
+    """Produces the AST of an empty dummy function to be filled in by ``fake_import_use(...)``. Parsed once per Pylint
+    run, on plugin registration.
+    """
+    return astroid.extract_node("def fake_import_use():\n    return []")
+
+
+def fake_import_use() -> astroid.FunctionDef:
+    """Produces the AST of a dummy function which references all the base imports. The AST is copied from a template
+    and filled in directly, so that no source code needs to be parsed for each module.
+    """
+    fake_f = copy.deepcopy(fake_import_use_template())
+
+    ret_list = fake_f.body[0].value
+    ret_list.elts = [
+        astroid.Name(name, lineno=None, col_offset=None, parent=ret_list, end_lineno=None, end_col_offset=None)
+        for name in base_exports
+    ]
+
+    return fake_f
+
+
+@functools.lru_cache(maxsize=None)
+def is_model_module(mod_name: str) -> bool:
+    """Determines whether classes in the module of the given name may be models. As this is checked for every class
+    visited by Astroid but depends only on the module, the result is computed once per module.
+    """
+    return mod_name.startswith("keylime.models") and not mod_name.startswith("keylime.models.base")
+
 
 def transform_model_class(cls: astroid.ClassDef) -> astroid.ClassDef:
     """Given the Astroid abstract syntax tree (AST) of a model class, modifies it to include those members which are not
@@ -56,13 +134,7 @@ def transform_model_class(cls: astroid.ClassDef) -> astroid.ClassDef:
     This has the effect of suppressing "access-member-before-definition" (E0203) and
     "attribute-defined-outside-init" (W0201) when accessing a field or association using dot notation.
     """
-    if (
-        isinstance(cls.parent, astroid.Module)
-        and cls.name
-        and cls.parent.name
-        and cls.parent.name.startswith("keylime.models")
-        and not cls.parent.name.startswith("keylime.models.base")
-    ):
+    if cls.name and isinstance(cls.parent, astroid.Module) and cls.parent.name and is_model_module(cls.parent.name):
         # Iterate over declarations in the body of the model's _schema method
         for exp in cls.locals["_schema"][0].body:
             # Only declarations which create a new field or association are relevant
@@ -105,30 +177,28 @@ def transform_model_module(mod: astroid.Module) -> astroid.Module:
     ):
         return mod
 
-    body = mod.body.copy()
     base_pkg = "keylime.models.base"
 
-    # Iterate over statements in the module body
-    for i, item in enumerate(body):
+    # Iterate over statements in the module body, only copying the body once the statement to replace has been found
+    for i, item in enumerate(mod.body):
         # Only process the statement if it is a wildcard import of "keylime.models.base"
-        if isinstance(item, astroid.ImportFrom) and item.modname == base_pkg and item.names == [("*", None)]:
-            # From the list of base imports produced by the ``register(...)`` function, generate a list of import names
-            # without any aliases (specifying None)
-            import_names = [(name, None) for name in base_exports]  # type: list[tuple[str, str | None]]
-            # Replace the wildcard import statement with a new import statement with all imports explicitly named
-            body[i] = astroid.ImportFrom(base_pkg, import_names, item.level, item.lineno, item.col_offset, item.parent)
-
-            # Create new dummy function to reference the imports and avoid "unused-import" warnings
-            fake_f_code = f"def fake_import_use():\n" f"    return [{', '.join(base_exports)}]"
-
-            # Get AST from dummy function and append it to the end of the statement tree
-            fake_f = astroid.extract_node(fake_f_code, mod.name)
-            body.append(fake_f)
-            # Update module AST with altered statement tree
-            mod.postinit(body)
-
-            # Once a wildcard import of "keylime.models.base" is found, we can skip searching the rest of the tree
-            break
+        if not isinstance(item, astroid.ImportFrom) or item.names != [("*", None)] or item.modname != base_pkg:
+            continue
+
+        # Replace the wildcard import statement with a new import statement with all imports explicitly named
+        new_import = astroid.ImportFrom(
+            base_pkg, base_import_names(), item.level, item.lineno, item.col_offset, item.parent
+        )
+
+        # Get AST from dummy function, which references the imports to avoid "unused-import" warnings, and append
+        # it to the end of the statement tree
+        fake_f = fake_import_use()
+
+        # Update module AST with altered statement tree
+        mod.postinit(mod.body[:i] + [new_import] + mod.body[i + 1 :] + [fake_f])
+
+        # Once a wildcard import of "keylime.models.base" is found, we can skip searching the rest of the tree
+        break
 
     return mod
 
@@ -0,0 +1,25 @@
+"""
+Helpers shared by the durable attestation tests.
+"""
+
+from typing import Any, Callable, Dict, Optional
+from unittest.mock import patch
+
+
+def _lookup(options: Dict[str, Any], convert: Callable[[Any], Any]) -> Callable[..., Any]:
+    def get(_component: str, option: str, _section: Optional[str] = None, fallback: Any = None) -> Any:
+        if option in options:
+            return convert(options[option])
+        return fallback
+
+    return get
+
+
+def make_record_management(cls: Any, service: str = "verifier", **options: Any) -> Any:
+    """Instantiates the durable attestation record manager ``cls`` for ``service``, configured with the given options
+    (e.g., ``persistent_store_format="msgpack"``). Any other option takes its fallback value, so that the tests do not
+    depend on the configuration files installed on the system."""
+    with patch("keylime.config.get", side_effect=_lookup(options, str)), patch(
+        "keylime.config.getint", side_effect=_lookup(options, int)
+    ), patch("keylime.config.getfloat", side_effect=_lookup(options, float)):
+        return cls(service)
@@ -0,0 +1,141 @@
+import base64
+import unittest
+from test import da_utils
+from unittest.mock import patch
+
+from keylime.da import record
+
+RECORD = {
+    "agent": {"agentid": "d432fbb3-d2f1-4a97-9ef7-75bd81c00000", "aik_tpm": "AIK", "port": 9002},
+    "json_response": {"nonce": "1234567890", "hash_alg": "sha256", "quote": "r/1RDR4AYABYABPOGaGJz"},
+    "policy": None,
+}
+
+
+class RecordManagement(record.BaseRecordManagement):
+    def record_create(
+        self,
+        agent_data,
+        attestation_data,
+        mb_policy_data,
+        runtime_policy_data,
+        service="auto",
+        signed_attributes="auto",
+    ):
+        pass
+
+
+def make_record_management(fmt="json", enc="", cmp=""):
+    return da_utils.make_record_management(
+        RecordManagement,
+        persistent_store_format=fmt,
+        persistent_store_encoding=enc,
+        persistent_store_compression=cmp,
+    )
+
+
+class TestRecordSerialization(unittest.TestCase):
+    def test_round_trip_json(self):
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                rm = make_record_management("json", enc)
+                self.assertEqual(rm.record_deserialize(rm.record_serialize(RECORD)), RECORD)
+
+    @unittest.skipUnless(record.msgpack, "msgpack module not installed")
+    def test_round_trip_msgpack(self):
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                rm = make_record_management("msgpack", enc)
+                serialized = rm.record_serialize(RECORD)
+                self.assertNotEqual(serialized, make_record_management("json", enc).record_serialize(RECORD))
+                self.assertEqual(rm.record_deserialize(serialized), RECORD)
+
+    @unittest.skipUnless(record.msgpack, "msgpack module not installed")
+    def test_json_record_read_as_msgpack(self):
+        """Records written as JSON can still be read after switching the store to msgpack"""
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                serialized = make_record_management("json", enc).record_serialize(RECORD)
+                self.assertEqual(make_record_management("msgpack", enc).record_deserialize(serialized), RECORD)
+
+    @unittest.skipUnless(record.msgpack, "msgpack module not installed")
+    def test_msgpack_bytes_read_as_str(self):
+        """Bytes are stored as str, as with JSON, so that records read back with the same shape in either format"""
+        record_with_bytes = {"agent": {"aik_tpm": b"AIK"}}
+        records = [
+            make_record_management(fmt).record_deserialize(
+                make_record_management(fmt).record_serialize(record_with_bytes)
+            )
+            for fmt in ("json", "msgpack")
+        ]
+        self.assertEqual(records[0], records[1])
+        self.assertEqual(record.base_build_key_list(records), ["AIK"])
+
+    @unittest.skipUnless(record.msgpack, "msgpack module not installed")
+    def test_msgpack_non_str_keys_read_as_str(self):
+        """Dict keys are stored as str, as with JSON, so that records read back with the same shape in either format"""
+        record_with_int_keys = {"agent": {"pcrs": {10: "x", 16: "y"}, "flags": {None: 1, True: 2, 1.5: 3}}}
+        records = [
+            make_record_management(fmt).record_deserialize(
+                make_record_management(fmt).record_serialize(record_with_int_keys)
+            )
+            for fmt in ("json", "msgpack")
+        ]
+        self.assertEqual(records[0], records[1])
+        self.assertEqual(records[1]["agent"]["pcrs"], {"10": "x", "16": "y"})
+
+    @unittest.skipUnless(record.msgpack, "msgpack module not installed")
+    def test_msgpack_unsupported_type_rejected(self):
+        """Objects that JSON cannot serialize are rejected, rather than silently converted to str"""
+        for fmt in ("json", "msgpack"):
+            with self.subTest(fmt=fmt):
+                with self.assertRaises(TypeError):
+                    make_record_management(fmt).record_serialize({"agent": {"created": object()}})
+
+    def test_msgpack_missing(self):
+        rm = make_record_management("msgpack")
+        with patch("keylime.da.record.msgpack", None):
+            with self.assertRaises(record.RecordManagementException):
+                rm.record_serialize(RECORD)
+            with self.assertRaises(record.RecordManagementException):
+                rm.record_deserialize(record.MSGPACK_RECORD_V1 + b"\x80")
+
+    @unittest.skipUnless(record.zstandard, "zstandard module not installed")
+    def test_round_trip_zstd(self):
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                rm = make_record_management("json", enc, "zstd")
+                serialized = rm.record_serialize(RECORD)
+                if enc == "base64":
+                    self.assertEqual(base64.b64decode(serialized)[:4], record.ZSTD_FRAME_MAGIC)
+                else:
+                    self.assertEqual(serialized[:4], record.ZSTD_FRAME_MAGIC)
+                self.assertEqual(rm.record_deserialize(serialized), RECORD)
+
+    @unittest.skipUnless(record.zstandard, "zstandard module not installed")
+    def test_zstd_record_read_uncompressed(self):
+        """Compressed records can still be read after compression is disabled"""
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                serialized = make_record_management("json", enc, "zstd").record_serialize(RECORD)
+                self.assertEqual(make_record_management("json", enc).record_deserialize(serialized), RECORD)
+
+    @unittest.skipUnless(record.zstandard, "zstandard module not installed")
+    def test_uncompressed_record_read_zstd(self):
+        """Uncompressed records can still be read after compression is enabled"""
+        for enc in ("", "base64"):
+            with self.subTest(enc=enc):
+                serialized = make_record_management("json", enc).record_serialize(RECORD)
+                self.assertEqual(make_record_management("json", enc, "zstd").record_deserialize(serialized), RECORD)
+
+    def test_zstd_missing(self):
+        rm = make_record_management("json", "", "zstd")
+        with patch("keylime.da.record.zstandard", None):
+            with self.assertRaises(record.RecordManagementException):
+                rm.record_serialize(RECORD)
+            with self.assertRaises(record.RecordManagementException):
+                rm.record_deserialize(record.ZSTD_FRAME_MAGIC + b"\x00")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,303 @@
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from test import da_utils
+from unittest.mock import patch
+from urllib.parse import urlparse
+
+import sqlalchemy
+
+from keylime.da.examples import sqldb
+
+AGENT_ID = "d432fbb3-d2f1-4a97-9ef7-75bd81c00000"
+OTHER_AGENT_ID = "d432fbb3-d2f1-4a97-9ef7-75bd81c00001"
+
+# A timestamp, in seconds, as the records of earlier versions of the backend were timestamped with
+T = 1700000000
+
+
+def make_record_management(url, service="verifier", **options):
+    return da_utils.make_record_management(sqldb.RecordManagement, service, persistent_store_url=url, **options)
+
+
+class TestSQLRecordStoreUpgrade(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.url = f"sqlite:///{os.path.join(self.tmpdir.name, 'da.sqlite')}"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_old_store(self, times, agent_ids=(AGENT_ID,)):
+        """Creates a persistent store as written by earlier versions of the backend: records timestamped in seconds
+        and no StoreVersion table"""
+        serializer = make_record_management("sqlite://")
+        engine = sqlalchemy.create_engine(self.url)
+        metadata = sqlalchemy.MetaData()
+        table = sqlalchemy.Table(
+            "AttestationRecord",
+            metadata,
+            sqlalchemy.Column("time", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("agentid", sqlalchemy.String(128), primary_key=True),
+            sqlalchemy.Column("record", sqlalchemy.LargeBinary(length=(2**32) - 1)),
+        )
+        metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(
+                table.insert(),
+                [
+                    {"time": t, "agentid": agent_id, "record": serializer.record_serialize({"agent": {"time": t}})}
+                    for agent_id in agent_ids
+                    for t in times
+                ],
+            )
+        engine.dispose()
+
+    def stored_times(self, rm):
+        with rm.engine.connect() as conn:
+            return sorted(row.time for row in conn.execute(sqldb.AttestationRecord.__table__.select()))
+
+    def read_times(self, rm, start_date, end_date, agent_id=AGENT_ID):
+        return [r["agent"]["time"] for r in rm.record_read(agent_id, start_date, end_date, service="verifier")]
+
+    def test_new_store_is_current(self):
+        rm = make_record_management(self.url)
+        self.assertEqual(rm.store_version, sqldb.STORE_VERSION)
+
+    def test_old_store_read_before_and_after_upgrade(self):
+        self.make_old_store([T, T + 1, T + 2])
+
+        rm = make_record_management(self.url)
+        self.assertEqual(rm.store_version, 1)
+        self.assertEqual(self.stored_times(rm), [T, T + 1, T + 2])
+        self.assertEqual(self.read_times(rm, T + 1, T + 2), [T + 1, T + 2])
+
+        rm.upgrade_store()
+        self.assertEqual(rm.store_version, sqldb.STORE_VERSION)
+        self.assertEqual(self.stored_times(rm), [T * 1000, (T + 1) * 1000, (T + 2) * 1000])
+        self.assertEqual(self.read_times(rm, T + 1, T + 2), [T + 1, T + 2])
+        self.assertEqual(self.read_times(rm, 0, T + 1), [T, T + 1])
+
+    def test_upgrade_in_batches(self):
+        agent_ids = [AGENT_ID, OTHER_AGENT_ID]
+        times = [T + i for i in range(5)]
+        self.make_old_store(times, agent_ids)
+
+        rm = make_record_management(self.url)
+        rm.upgrade_batch_size = 3
+        rm.upgrade_store()
+
+        self.assertEqual(self.stored_times(rm), sorted(t * 1000 for t in times for _ in agent_ids))
+        for agent_id in agent_ids:
+            self.assertEqual(self.read_times(rm, T, T + 4, agent_id), times)
+
+    def test_upgrade_runs_once(self):
+        self.make_old_store([T, T + 1])
+
+        make_record_management(self.url).upgrade_store()
+        rm = make_record_management(self.url)
+        self.assertEqual(rm.store_version, sqldb.STORE_VERSION)
+        rm.upgrade_store()
+        rm.store_version = 1
+        rm.upgrade_store()
+
+        self.assertEqual(self.stored_times(rm), [T * 1000, (T + 1) * 1000])
+        self.assertEqual(self.read_times(rm, T, T + 1), [T, T + 1])
+
+    def test_interrupted_upgrade_resumes(self):
+        """An upgrade which stopped after rescaling some of the timestamps, but before recording its marker, does not
+        rescale them again when run anew"""
+        self.make_old_store([T, T + 1, T + 2])
+
+        rm = make_record_management(self.url)
+        with rm.engine.begin() as conn:
+            table = sqldb.AttestationRecord.__table__
+            conn.execute(table.update().where(table.c.time == T).values(time=T * 1000))
+
+        rm.upgrade_store()
+        self.assertEqual(self.stored_times(rm), [T * 1000, (T + 1) * 1000, (T + 2) * 1000])
+
+
+class TestSQLRecordRead(unittest.TestCase):
+    # Timestamps of the stored records, in milliseconds
+    TIMES = [1000000, 1000500, 1001999, 1002000, 1003000]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.rm = make_record_management(f"sqlite:///{os.path.join(self.tmpdir.name, 'da.sqlite')}")
+        with self.rm.engine.begin() as conn:
+            conn.execute(
+                sqldb.AttestationRecord.__table__.insert(),
+                [
+                    {"time": t, "agentid": AGENT_ID, "record": self.rm.record_serialize({"agent": {"time": t}})}
+                    for t in self.TIMES
+                ],
+            )
+
+    def tearDown(self):
+        self.rm.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def read_times(self, start_date, end_date):
+        return [r["agent"]["time"] for r in self.rm.record_read(AGENT_ID, start_date, end_date, service="verifier")]
+
+    def test_date_range_in_seconds(self):
+        """Dates are given in seconds and cover every millisecond of the end date"""
+        self.assertEqual(self.read_times(1000, 1001), [1000000, 1000500, 1001999])
+        self.assertEqual(self.read_times(1001, 1001), [1001999])
+        self.assertEqual(self.read_times(1002, 1002), [1002000])
+        self.assertEqual(self.read_times(0, self.rm.end_of_times), self.TIMES)
+
+    def test_empty_date_range(self):
+        self.assertEqual(self.read_times(5000, 6000), [])
+
+    def test_pagination(self):
+        for page_size in (1, 2, 3, len(self.TIMES), 200):
+            with self.subTest(page_size=page_size):
+                self.rm.page_size = page_size
+                self.assertEqual(self.read_times(0, self.rm.end_of_times), self.TIMES)
+                self.assertEqual(self.read_times(1000, 1002), self.TIMES[:4])
+
+    def test_pagination_with_sink(self):
+        self.rm.max_workers = 2
+        records = self.rm._record_stream(  # pylint: disable=protected-access
+            AGENT_ID, 0, service="verifier", sink=lambda r: r["agent"]["time"]
+        )
+        self.assertEqual(list(records), self.TIMES)
+
+    def test_checked_sequentially_without_tl_or_tsa(self):
+        with patch.object(self.rm.executor, "map", side_effect=AssertionError("executor used")):
+            self.assertEqual(self.read_times(0, self.rm.end_of_times), self.TIMES)
+
+    def test_concurrent_checks_keep_row_order(self):
+        """Records are returned in row order even when later rows are checked before earlier ones"""
+        self.rm.tl_url = urlparse("http://127.0.0.1:3000")
+        self.rm.max_workers = len(self.TIMES)
+        self.rm.executor = ThreadPoolExecutor(max_workers=len(self.TIMES))
+        self.addCleanup(self.rm.executor.shutdown)
+
+        def record_signature_check(record_object, _record_identifier):
+            # The earlier the record, the longer its check takes
+            time.sleep((self.TIMES[-1] - record_object["agent"]["time"]) / 100000)
+
+        with patch.object(self.rm, "record_signature_check", side_effect=record_signature_check):
+            self.assertEqual(self.read_times(0, self.rm.end_of_times), self.TIMES)
+            records = self.rm._record_stream(  # pylint: disable=protected-access
+                AGENT_ID, 0, service="verifier", sink=lambda r: r["agent"]["time"]
+            )
+            self.assertEqual(list(records), self.TIMES)
+
+    def test_only_last(self):
+        self.assertEqual(self.read_times(self.rm.end_of_times - 1, self.rm.end_of_times), [1003000])
+
+
+class TestSQLRecordCreate(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.url = f"sqlite:///{os.path.join(self.tmpdir.name, 'da.sqlite')}"
+        # Records are timestamped one millisecond apart, unless a test says otherwise
+        self.times = iter(range(T * 1000, T * 1000 + 1000))
+        time_patcher = patch("keylime.da.examples.sqldb.time")
+        time_patcher.start().time_ns.side_effect = lambda: next(self.times) * 1_000_000
+        self.addCleanup(time_patcher.stop)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_record_management(self, batch_size, flush_interval):
+        rm = make_record_management(
+            self.url, persistent_store_batch_size=batch_size, persistent_store_flush_interval=flush_interval
+        )
+        self.addCleanup(rm.engine.dispose)
+        self.addCleanup(rm.flush)
+        return rm
+
+    def create_records(self, rm, count):
+        for _ in range(count):
+            rm.record_create({"agent_id": AGENT_ID}, {"quote": "q"}, None, None, signed_attributes="")
+
+    def stored_count(self, rm):
+        with rm.engine.connect() as conn:
+            return len(conn.execute(sqldb.AttestationRecord.__table__.select()).fetchall())
+
+    def test_unbatched_by_default(self):
+        rm = make_record_management(self.url)
+        self.assertEqual(rm.batch_size, 1)
+        self.create_records(rm, 1)
+        self.assertEqual(self.stored_count(rm), 1)
+
+    def test_written_once_batch_is_full(self):
+        rm = self.make_record_management(3, 0)
+        self.create_records(rm, 2)
+        self.assertEqual(self.stored_count(rm), 0)
+        self.create_records(rm, 1)
+        self.assertEqual(self.stored_count(rm), 3)
+        self.assertFalse(rm.queues[sqldb.AttestationRecord])
+
+    def test_written_once_flush_interval_elapsed(self):
+        rm = self.make_record_management(100, 0.2)
+        self.create_records(rm, 2)
+        self.assertEqual(self.stored_count(rm), 0)
+
+        timer = rm.flush_timer
+        self.assertIsNotNone(timer)
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertEqual(self.stored_count(rm), 2)
+        self.assertIsNone(rm.flush_timer)
+
+    def test_batch_with_duplicate_key_written_one_by_one(self):
+        rm = self.make_record_management(3, 0)
+        self.times = iter([T * 1000, T * 1000, T * 1000 + 1])
+        with self.assertLogs("keylime.durable_attestation_persistent_store", "ERROR"):
+            self.create_records(rm, 3)
+        self.assertEqual(self.stored_count(rm), 2)
+
+    def test_flushed_before_read(self):
+        rm = self.make_record_management(100, 0)
+        self.create_records(rm, 2)
+        self.assertEqual(self.stored_count(rm), 0)
+        self.assertEqual(len(rm.record_read(AGENT_ID, 0, rm.end_of_times, service="verifier")), 2)
+        self.assertEqual(rm.agent_list_retrieval(service="verifier"), [AGENT_ID])
+
+    @unittest.skipUnless(hasattr(os, "fork"), "os.fork() not available")
+    def test_forked_worker_starts_afresh(self):
+        rm = self.make_record_management(100, 0)
+        self.create_records(rm, 1)
+        self.assertEqual(rm.engine.pool.checkedin(), 1)
+
+        pid = os.fork()
+        if pid == 0:
+            # Neither the parent's pooled connections nor its queued records are inherited
+            ok = rm.engine.pool.checkedin() == 0 and not rm.queues[sqldb.AttestationRecord]
+            self.create_records(rm, 1)
+            rm.flush()
+            os._exit(0 if ok else 1)  # pylint: disable=protected-access
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(self.stored_count(rm), 1)
+        rm.flush()
+        self.assertEqual(self.stored_count(rm), 2)
+
+    def test_build_key_list(self):
+        rm = self.make_record_management(1, 0)
+        rm.max_workers = 1
+        for aik in ("AIK1", "AIK2", "AIK1", "AIK3"):
+            rm.record_create({"agent_id": AGENT_ID, "aik_tpm": aik}, None, None, None, "registrar", "")
+
+        statements = []
+        sqlalchemy.event.listen(
+            rm.engine, "before_cursor_execute", lambda _c, _cur, statement, *_: statements.append(statement)
+        )
+        self.assertEqual(rm.build_key_list(AGENT_ID, "registrar"), ["AIK1", "AIK2", "AIK3"])
+        self.assertEqual(rm.build_key_list(OTHER_AGENT_ID, "registrar"), [])
+
+        # Records are streamed one per worker, yet fetched with one query per page
+        self.assertEqual(len([s for s in statements if '"RegistrationRecord"' in s]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()